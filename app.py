@@ -2,16 +2,21 @@ from flask import Flask, render_template, request, session, redirect, url_for
 from flask_login import current_user
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from flask_session import Session
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_wtf.csrf import CSRFProtect
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex
 import os
 
 # Import configurations
 from config import config
 
 # Import models
-from models.user import db, User
+from models.user import db, User, Account, Transaction, password_hasher, dialect_insert
 
 # Import routes
 from routes.auth import auth_bp
@@ -20,16 +25,41 @@ from routes.admin import admin_bp
 
 # Import utilities
 from utils.security import SecurityUtils
+from utils.cache import cache
+from utils.session_user import SessionUser
+from utils.query_stats import init_query_cache_stats
+from utils.attempt_sink import attempt_sink
 
 def create_app(config_name='development'):
     """Application factory pattern"""
     app = Flask(__name__)
+    # Keep every compiled template in memory (jinja_env is created lazily)
+    app.jinja_options = {**app.jinja_options, 'cache_size': 400}
     
     # Load configuration
     app.config.from_object(config[config_name])
     
+    # Resolve the client address from trusted proxy headers once per request
+    # (only when a proxy is configured; otherwise X-Forwarded-For is client-controlled)
+    proxy_x_for = app.config.get('PROXY_FIX_X_FOR', 0)
+    proxy_x_proto = app.config.get('PROXY_FIX_X_PROTO', 0)
+    if proxy_x_for or proxy_x_proto:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_x_for, x_proto=proxy_x_proto)
+    
+    # Persist compiled template bytecode so new workers skip parsing templates
+    if app.config.get('JINJA_BYTECODE_CACHE'):
+        # An explicit directory must be private to the app user: Jinja loads these files as code
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config.get('JINJA_BYTECODE_CACHE_DIR'))
+    
     # Initialize extensions
     db.init_app(app)
+    if app.config.get('SQLALCHEMY_LOG_CACHE_STATS'):
+        init_query_cache_stats()
+    cache.init_app(app)
+    
+    # Server-side sessions when a session backend is configured
+    if app.config.get('SESSION_TYPE'):
+        Session(app)
     
     # Initialize CSRF Protection
     csrf = CSRFProtect(app)
@@ -43,13 +73,18 @@ def create_app(config_name='development'):
     
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        # Role and status are stored in the session at login, so most requests
+        # never query the users table; sessions without claims load the row
+        role = session.get('role')
+        if role is None:
+            return db.session.get(User, int(user_id))
+        return SessionUser(int(user_id), role, session.get('is_active', True))
     
     # Initialize Rate Limiter
     limiter = Limiter(
         key_func=get_remote_address,
         default_limits=["100 per hour"],
-        storage_uri="memory://"
+        storage_uri=app.config['RATELIMIT_STORAGE_URL']
     )
     limiter.init_app(app)
     
@@ -59,26 +94,32 @@ def create_app(config_name='development'):
     # Exempt authenticated admin users from rate limiting (e.g., on admin dashboard)
     @limiter.request_filter
     def skip_limits_for_admins():
-        try:
-            return current_user.is_authenticated and current_user.is_admin()
-        except Exception:
+        # Anonymous requests short-circuit on the session cookie; the role claim
+        # cached at login answers the rest, so no user row is loaded here
+        if not session.get('_user_id'):
             return False
+        return session.get('role') == 'admin'
     
     # Initialize Security Utils
     security = SecurityUtils(app)
     
+    # Batched writer for failed login attempts
+    attempt_sink.init_app(app)
+    
     # Register blueprints
     app.register_blueprint(auth_bp)
     app.register_blueprint(dashboard_bp)
     app.register_blueprint(admin_bp)
     
-    # Security headers middleware
+    # Security headers middleware (pairs are built once, not per response)
+    security_headers = tuple(app.config.get('SECURITY_HEADERS', {}).items())
+    
     @app.after_request
     def add_security_headers(response):
         """Add security headers to all responses"""
-        headers = app.config.get('SECURITY_HEADERS', {})
-        for header, value in headers.items():
-            response.headers[header] = value
+        headers = response.headers
+        for header, value in security_headers:
+            headers[header] = value
         return response
     
     # Error handlers
@@ -108,25 +149,65 @@ def create_app(config_name='development'):
             return redirect(url_for('dashboard.index'))
         return render_template('index.html')
     
-    # Create database tables
-    with app.app_context():
-        db.create_all()
-        
-        # Create default admin user if not exists
-        admin_user = User.query.filter_by(username='admin').first()
-        if not admin_user:
-            admin = User(
-                username='admin',
-                email='admin@securebank.com',
-                full_name='System Administrator',
-                role='admin'
-            )
-            admin.set_password('Admin123!')
-            db.session.add(admin)
-            db.session.commit()
+    # Database bootstrap runs once from the CLI, not on every worker start
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create tables, indexes and the default admin user"""
+        init_db()
+        print('Database initialized.')
     
     return app
 
+def init_db():
+    """Create database tables and the default admin user (requires app context)"""
+    db.create_all()
+    
+    # create_all() skips existing tables, so add any newer indexes explicitly
+    # (IF NOT EXISTS also covers expression indexes, which inspection can't see)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+    
+    # Trigram indexes make the admin ILIKE '%term%' searches index-backed on PostgreSQL
+    if db.engine.dialect.name == 'postgresql':
+        create_trigram_indexes()
+    
+    # Create default admin user if not exists
+    # The database deduplicates atomically, so concurrent runs cannot race
+    db.session.execute(
+        dialect_insert(User).values(
+            username='admin',
+            email='admin@securebank.com',
+            full_name='System Administrator',
+            role='admin',
+            password_hash=password_hasher.hash('Admin123!')
+        ).on_conflict_do_nothing()
+    )
+    db.session.commit()
+
+def create_trigram_indexes():
+    """Create pg_trgm GIN indexes for the columns searched from the admin panel"""
+    searchable = [
+        (User.__table__, 'username'),
+        (User.__table__, 'email'),
+        (User.__table__, 'full_name'),
+        (Account.__table__, 'account_number'),
+        (Transaction.__table__, 'description'),
+    ]
+    quote = db.engine.dialect.identifier_preparer.quote
+    with db.engine.begin() as conn:
+        conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        for table, column in searchable:
+            index_name = f'ix_{table.name.split()[0]}_{column}_trgm'
+            conn.execute(text(
+                f'CREATE INDEX IF NOT EXISTS {quote(index_name)} '
+                f'ON {quote(table.name)} USING gin ({quote(column)} gin_trgm_ops)'
+            ))
+
 if __name__ == '__main__':
     app = create_app()
+    # Development server convenience; production uses `flask --app app init-db`
+    with app.app_context():
+        init_db()
     app.run(debug=True, host='127.0.0.1', port=5000)
@@ -1,4 +1,5 @@
 import os
+import redis
 from datetime import timedelta
 
 class Config:
@@ -8,6 +9,13 @@ class Config:
     # Database Configuration
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///secure_bank.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'query_cache_size': 1200,  # Compiled statement cache entries per engine
+        'echo': False,
+        'pool_pre_ping': True,  # Drop dead connections before handing them out
+        'pool_recycle': 1800
+    }
+    SQLALCHEMY_LOG_CACHE_STATS = False
     
     # Security Configuration
     WTF_CSRF_ENABLED = True
@@ -19,10 +27,28 @@ class Config:
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SAMESITE = 'Lax'
     
+    # Server-side sessions in Redis (Flask-Session), separate DB from the limiter
+    SESSION_TYPE = 'redis'
+    SESSION_REDIS = redis.from_url(os.environ.get('SESSION_REDIS_URL') or 'redis://localhost:6379/1')
+    SESSION_USE_SIGNER = True
+    
+    # Reverse proxy hops trusted for X-Forwarded-For / X-Forwarded-Proto (ProxyFix)
+    # 0 = trust no forwarded headers; only raise this when the app is behind that many proxies
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR', 0))
+    PROXY_FIX_X_PROTO = int(os.environ.get('PROXY_FIX_X_PROTO', 0))
+    
     # Rate Limiting Configuration
     RATELIMIT_STORAGE_URL = "redis://localhost:6379"
     RATELIMIT_DEFAULT = "100 per hour"
     
+    # Cache Configuration (admin dashboard statistics)
+    CACHE_TYPE = 'RedisCache'
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL') or 'redis://localhost:6379/2'
+    CACHE_DEFAULT_TIMEOUT = 30
+    
+    # Failed-login counters (atomic INCR shared by all workers), same Redis DB as the cache
+    LOCKOUT_REDIS = redis.from_url(CACHE_REDIS_URL)
+    
     # Encryption Configuration
     ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY') or 'default-encryption-key-change-me'
     
@@ -38,9 +64,30 @@ class Config:
 class DevelopmentConfig(Config):
     DEBUG = True
     SESSION_COOKIE_SECURE = False
+    RATELIMIT_STORAGE_URL = "memory://"  # Redis is optional in development
+    SESSION_TYPE = None  # Signed cookie sessions
+    SQLALCHEMY_LOG_CACHE_STATS = True
+    CACHE_TYPE = 'SimpleCache'
+    LOCKOUT_REDIS = None  # Count in the in-process cache
 
 class ProductionConfig(Config):
     DEBUG = False
+    TEMPLATES_AUTO_RELOAD = False
+    # Production runs behind a single reverse proxy (nginx in front of gunicorn)
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR', 1))
+    PROXY_FIX_X_PROTO = int(os.environ.get('PROXY_FIX_X_PROTO', 1))
+    # Compiled template bytecode; without a directory Jinja uses a private per-user 0700 temp dir
+    JINJA_BYTECODE_CACHE = True
+    JINJA_BYTECODE_CACHE_DIR = os.environ.get('JINJA_BYTECODE_CACHE_DIR')
+    
+    # Connection pool sizing for a server database (SQLite uses its own pools)
+    # Keep pool_size + max_overflow <= database max_connections / number of workers
+    if not Config.SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            **Config.SQLALCHEMY_ENGINE_OPTIONS,
+            'pool_size': 10,
+            'max_overflow': 20
+        }
 
 config = {
     'development': DevelopmentConfig,
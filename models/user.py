@@ -1,13 +1,39 @@
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 from datetime import datetime, timedelta
 import secrets
+from utils.cache import cache
 
 db = SQLAlchemy()
 
+# Argon2id hasher shared by all users (C implementation via argon2-cffi)
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=1)
+
+# Login lookups cache only what the auth decision needs (never the password hash)
+AUTH_CACHE_TIMEOUT = 60
+
+# Failed passwords are counted in Redis; the row is only written when the account locks
+LOCKOUT_THRESHOLD = 3
+LOCKOUT_MINUTES = 30
+
+def dialect_insert(model):
+    """INSERT construct for the bound database, with ON CONFLICT support"""
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql_insert(model)
+    return sqlite_insert(model)
+
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        db.Index('ix_user_created', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False, index=True)
@@ -30,13 +56,92 @@ class User(UserMixin, db.Model):
     accounts = db.relationship('Account', backref='owner', lazy=True, cascade='all, delete-orphan')
     transactions = db.relationship('Transaction', backref='user', lazy=True)
     
+    @staticmethod
+    def _auth_cache_key(username):
+        return f'auth_user:{username}'
+    
+    @classmethod
+    def get_auth_record(cls, username):
+        """Cached id/status/lock info for a username, or None if no such user"""
+        key = cls._auth_cache_key(username)
+        record = cache.get(key)
+        if record is None:
+            user = cls.query.filter_by(username=username).first()
+            # Unknown usernames are cached as {} so repeated guesses skip the database
+            record = {
+                'id': user.id,
+                'is_active': user.is_active,
+                'account_locked_until': user.account_locked_until
+            } if user else {}
+            cache.set(key, record, timeout=AUTH_CACHE_TIMEOUT)
+        return record or None
+    
+    @staticmethod
+    def _failed_login_key(username):
+        return f'failed_login:{username}'
+    
+    @classmethod
+    def record_failed_login(cls, username):
+        """Count a failed password; returns the count within the lockout window"""
+        key = cls._failed_login_key(username)
+        client = current_app.config.get('LOCKOUT_REDIS')
+        if client is not None:
+            # INCR + EXPIRE in one round trip, atomic across workers
+            pipe = client.pipeline()
+            pipe.incr(key)
+            pipe.expire(key, LOCKOUT_MINUTES * 60)
+            return pipe.execute()[0]
+        
+        failed_attempts = (cache.get(key) or 0) + 1
+        cache.set(key, failed_attempts, timeout=LOCKOUT_MINUTES * 60)
+        return failed_attempts
+    
+    @classmethod
+    def reset_failed_logins(cls, username):
+        """Forget the failed-password count for a username"""
+        key = cls._failed_login_key(username)
+        client = current_app.config.get('LOCKOUT_REDIS')
+        if client is not None:
+            client.delete(key)
+        else:
+            cache.delete(key)
+    
+    @classmethod
+    def invalidate_auth_cache_for(cls, username):
+        """Drop the cached auth record for a username"""
+        cache.delete(cls._auth_cache_key(username))
+    
+    def invalidate_auth_cache(self):
+        """Drop the cached auth record; call after committing a lock, unlock or status change"""
+        self.invalidate_auth_cache_for(self.username)
+    
+    def clear_auth_state(self):
+        """Reset the failed-password count and drop the cached auth record; call after committing a lock or unlock"""
+        self.reset_failed_logins(self.username)
+        self.invalidate_auth_cache()
+    
     def set_password(self, password):
-        """Hash and set password with strong hashing تعيين كلمة مرور مع هااااش قوي """
-        self.password_hash = generate_password_hash(password, method='pbkdf2:sha256:100000')
+        """Hash and set password with Argon2id تعيين كلمة مرور مع هاش قوي"""
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
         """Check password against hash التحقق من كلمة المرور مقابل الهاش"""
-        return check_password_hash(self.password_hash, password)
+        if not self.password_hash.startswith('$argon2'):
+            # Legacy PBKDF2 hash: verify with werkzeug and upgrade on success
+            if check_password_hash(self.password_hash, password):
+                self.set_password(password)
+                return True
+            return False
+        
+        try:
+            password_hasher.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        
+        # Re-hash when the hasher parameters have been raised since this hash was made
+        if password_hasher.check_needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
     
     def is_account_locked(self):
         """Check if account is currently locked التحقق اذا كان الحساب مغلقا حاليا"""
@@ -44,11 +149,10 @@ class User(UserMixin, db.Model):
             return datetime.utcnow() < self.account_locked_until
         return False
     
-    def lock_account(self):
+    def lock_account(self, failed_attempts=LOCKOUT_THRESHOLD):
         """Lock account for 30 minutes after 3 failed attempts اغلاق الحساب بعد 30 دقيقه من عدم النشاط"""
-        self.failed_login_attempts += 1
-        if self.failed_login_attempts >= 3:
-            self.account_locked_until = datetime.utcnow() + timedelta(minutes=30)
+        self.failed_login_attempts = failed_attempts
+        self.account_locked_until = datetime.utcnow() + timedelta(minutes=LOCKOUT_MINUTES)
     
     def unlock_account(self):
         """Unlock account and reset failed attempts فتح الحساب واعادة المحاوله"""
@@ -89,12 +193,23 @@ class Account(db.Model):
                                     foreign_keys='Transaction.to_account_id',
                                     backref='to_account', lazy=True)
     
-    def generate_account_number(self):
-        """Generate unique account number"""
-        while True:
-            account_num = ''.join([str(secrets.randbelow(10)) for _ in range(10)])
-            if not Account.query.filter_by(account_number=account_num).first():
-                return account_num
+    @staticmethod
+    def generate_account_number():
+        """Generate a random 10-digit account number (uniqueness enforced by the DB)"""
+        return f'{secrets.randbelow(10 ** 10):010d}'
+    
+    def insert_with_retry(self, attempts=3):
+        """Insert and commit the account, regenerating the number on a unique collision"""
+        for attempt in range(attempts):
+            db.session.add(self)
+            try:
+                db.session.commit()
+                return
+            except IntegrityError:
+                db.session.rollback()
+                if attempt == attempts - 1:
+                    raise
+                self.account_number = self.generate_account_number()
     
     def __init__(self, **kwargs):
         super(Account, self).__init__(**kwargs)
@@ -106,6 +221,12 @@ class Account(db.Model):
 
 class Transaction(db.Model):
     __tablename__ = 'transactions المعاملات'
+    __table_args__ = (
+        db.Index('ix_tx_created', 'created_at'),
+        db.Index('ix_tx_user_created', 'user_id', 'created_at'),
+        db.Index('ix_tx_from', 'from_account_id', 'created_at'),
+        db.Index('ix_tx_to', 'to_account_id', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     transaction_type = db.Column(db.String(20), nullable=False)  # 'transfer', 'deposit', 'withdrawal'
@@ -127,8 +248,17 @@ class Transaction(db.Model):
     def __repr__(self):
         return f'<Transaction {self.id}: {self.transaction_type} - {self.amount}>'
 
+# Expression index backing the daily volume report (GROUP BY date(created_at))
+db.Index('ix_tx_date', db.func.date(Transaction.created_at))
+
 class LoginAttempt(db.Model):
     __tablename__ = 'login_attempts'
+    __table_args__ = (
+        # Security dashboard and failed-login counters فهارس لوحة الامان
+        db.Index('ix_login_attempts_success_attempted', 'success', 'attempted_at'),
+        db.Index('ix_login_attempts_ip_success_attempted', 'ip_address', 'success', 'attempted_at'),
+        db.Index('ix_login_attempts_username_attempted', 'username', 'attempted_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     ip_address = db.Column(db.String(45), nullable=False, index=True)
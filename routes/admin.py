@@ -1,52 +1,41 @@
-from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify
+from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify, abort
 from flask_login import login_required, current_user
-from sqlalchemy import func, desc
+from sqlalchemy import func, desc, case, select
+from sqlalchemy.orm import joinedload, selectinload, aliased
 from datetime import datetime, timedelta
 from models.user import db, User, Account, Transaction, LoginAttempt
 from utils.decorators import admin_required
 from utils.security import SecurityUtils
+from utils.stats import dashboard_stats, invalidate_dashboard_stats
 from decimal import Decimal, InvalidOperation
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
+def _get_or_404(model, pk):
+    """Primary key lookup through the session identity map, 404 if missing"""
+    obj = db.session.get(model, pk)
+    if obj is None:
+        abort(404)
+    return obj
+
 @admin_bp.route('/')
 @login_required
 @admin_required
 def dashboard():
     """Admin dashboard with system overview"""
-    # System statistics
-    total_users = User.query.count()
-    total_accounts = Account.query.count()
-    total_transactions = Transaction.query.count()
-    active_users = User.query.filter_by(is_active=True).count()
+    # Cached for a short TTL so repeated refreshes don't hit the database
+    stats = dashboard_stats()
     
     # Recent activity نشاط حديث
     recent_users = User.query.order_by(desc(User.created_at)).limit(5).all()
-    recent_transactions = Transaction.query.order_by(desc(Transaction.created_at)).limit(10).all()
-    
-    # Security alerts تنبيهات امنية
-    failed_logins_today = LoginAttempt.query.filter(
-        LoginAttempt.success == False,
-        LoginAttempt.attempted_at >= datetime.utcnow().date()
-    ).count()
-    
-    locked_accounts = User.query.filter(
-        User.account_locked_until > datetime.utcnow()
-    ).count()
-    
-    # Financial statistics الاحصاءات الماليه
-    total_balance = db.session.query(func.sum(Account.balance)).scalar() or 0
+    recent_transactions = Transaction.query.options(
+        selectinload(Transaction.user)
+    ).order_by(desc(Transaction.created_at)).limit(10).all()
     
     return render_template('admin/dashboard.html',
-                         total_users=total_users,
-                         total_accounts=total_accounts,
-                         total_transactions=total_transactions,
-                         active_users=active_users,
                          recent_users=recent_users,
                          recent_transactions=recent_transactions,
-                         failed_logins_today=failed_logins_today,
-                         locked_accounts=locked_accounts,
-                         total_balance=total_balance)
+                         **stats)
 
 @admin_bp.route('/users')
 @login_required
@@ -57,12 +46,25 @@ def users():
     search = request.args.get('search', '', type=str)
     
     # البحث او الفلترة عن مستخدم
-    query = User.query
+    # Only the columns the listing renders; rows instead of full User instances
+    query = User.query.with_entities(
+        User.id,
+        User.username,
+        User.full_name,
+        User.email,
+        User.role,
+        User.is_active,
+        User.created_at,
+        User.last_login,
+        case((User.account_locked_until > datetime.utcnow(), True), else_=False).label('is_locked')
+    )
     if search:
+        # ILIKE is served by the pg_trgm GIN indexes on PostgreSQL (see init_db)
+        pattern = f'%{search}%'
         query = query.filter(
-            (User.username.contains(search)) |
-            (User.email.contains(search)) |
-            (User.full_name.contains(search))
+            (User.username.ilike(pattern)) |
+            (User.email.ilike(pattern)) |
+            (User.full_name.ilike(pattern))
         )
     
     users = query.order_by(desc(User.created_at)).paginate(
@@ -76,14 +78,44 @@ def users():
 @admin_required
 def user_details(user_id):
     """View specific user details"""
-    user = User.query.get_or_404(user_id)
-    accounts = Account.query.filter_by(user_id=user_id).all()
-    transactions = Transaction.query.filter_by(user_id=user_id).order_by(desc(Transaction.created_at)).limit(20).all()
-    login_attempts = LoginAttempt.query.filter_by(username=user.username).order_by(desc(LoginAttempt.attempted_at)).limit(10).all()
+    user = db.session.get(User, user_id, options=[selectinload(User.accounts)])
+    if user is None:
+        abort(404)
+    
+    # Recent transactions as plain rows with the account numbers joined in
+    from_account = aliased(Account)
+    to_account = aliased(Account)
+    transactions = db.session.execute(
+        select(
+            Transaction.transaction_type,
+            Transaction.amount,
+            Transaction.description,
+            Transaction.created_at,
+            Transaction.ip_address,
+            from_account.account_number.label('from_account_number'),
+            to_account.account_number.label('to_account_number')
+        ).outerjoin(from_account, Transaction.from_account_id == from_account.id)
+        .outerjoin(to_account, Transaction.to_account_id == to_account.id)
+        .where(Transaction.user_id == user_id)
+        .order_by(desc(Transaction.created_at))
+        .limit(20)
+    ).all()
+    
+    # Served by ix_login_attempts_username_attempted
+    login_attempts = db.session.execute(
+        select(
+            LoginAttempt.ip_address,
+            LoginAttempt.success,
+            LoginAttempt.user_agent,
+            LoginAttempt.attempted_at
+        ).where(LoginAttempt.username == user.username)
+        .order_by(desc(LoginAttempt.attempted_at))
+        .limit(10)
+    ).all()
     
     return render_template('admin/user_details.html',
                          user=user,
-                         accounts=accounts,
+                         accounts=user.accounts,
                          transactions=transactions,
                          login_attempts=login_attempts)
 
@@ -92,7 +124,7 @@ def user_details(user_id):
 @admin_required
 def toggle_user_status(user_id):
     """Toggle user active status تبديل الحالة النشط للمستخدم"""
-    user = User.query.get_or_404(user_id)
+    user = _get_or_404(User, user_id)
     
     if user.username == 'admin':
         flash('لا يمكن تعطيل حساب المدير الرئيسي', 'error')
@@ -100,6 +132,8 @@ def toggle_user_status(user_id):
     
     user.is_active = not user.is_active
     db.session.commit()
+    user.invalidate_auth_cache()
+    invalidate_dashboard_stats()
     
     status = 'تم تفعيل' if user.is_active else 'تم تعطيل'
     flash(f'{status} حساب المستخدم {user.username} بنجاح', 'success')
@@ -111,9 +145,11 @@ def toggle_user_status(user_id):
 @admin_required
 def unlock_user(user_id):
     """Unlock user account فتح حساب المستخدم"""
-    user = User.query.get_or_404(user_id)
+    user = _get_or_404(User, user_id)
     user.unlock_account()
     db.session.commit()
+    user.clear_auth_state()
+    invalidate_dashboard_stats()
     
     flash(f'تم إلغاء قفل حساب المستخدم {user.username} بنجاح', 'success')
     return redirect(url_for('admin.user_details', user_id=user_id))
@@ -123,7 +159,7 @@ def unlock_user(user_id):
 @admin_required
 def reset_user_password(user_id):
     """Reset user password اعادة تعيين كلمة السر للمستخدم وهذا بواسطة المسؤال فقط"""
-    user = User.query.get_or_404(user_id)
+    user = _get_or_404(User, user_id)
     new_password = request.form.get('new_password')
     
     if not new_password or len(new_password) < 8:
@@ -139,6 +175,7 @@ def reset_user_password(user_id):
     user.set_password(new_password)
     user.unlock_account()  # Unlock account when password is reset
     db.session.commit()
+    user.clear_auth_state()
     
     flash(f'تم تغيير كلمة مرور المستخدم {user.username} بنجاح', 'success')
     return redirect(url_for('admin.user_details', user_id=user_id))
@@ -151,12 +188,14 @@ def accounts():
     page = request.args.get('page', 1, type=int)
     search = request.args.get('search', '', type=str)
     
-    query = Account.query.join(User)
+    # Load owners in the same statement to avoid a query per row تحميل المالك مع الحساب
+    query = Account.query.join(User).options(joinedload(Account.owner))
     if search:
+        pattern = f'%{search}%'
         query = query.filter(
-            (Account.account_number.contains(search)) |
-            (User.username.contains(search)) |
-            (User.full_name.contains(search))
+            (Account.account_number.ilike(pattern)) |
+            (User.username.ilike(pattern)) |
+            (User.full_name.ilike(pattern))
         )
     
     accounts = query.order_by(desc(Account.created_at)).paginate(
@@ -170,7 +209,7 @@ def accounts():
 @admin_required
 def toggle_account_status(account_id):
     """Toggle account active status"""
-    account = Account.query.get_or_404(account_id)
+    account = _get_or_404(Account, account_id)
     account.is_active = not account.is_active
     db.session.commit()
     
@@ -187,11 +226,17 @@ def transactions():
     page = request.args.get('page', 1, type=int)
     search = request.args.get('search', '', type=str)
     
-    query = Transaction.query.join(User)
+    # Eager-load related rows used by the template تحميل العلاقات مسبقا
+    query = Transaction.query.join(User).options(
+        selectinload(Transaction.user),
+        joinedload(Transaction.from_account).joinedload(Account.owner),
+        joinedload(Transaction.to_account).joinedload(Account.owner)
+    )
     if search:
+        pattern = f'%{search}%'
         query = query.filter(
-            (Transaction.description.contains(search)) |
-            (User.username.contains(search))
+            (Transaction.description.ilike(pattern)) |
+            (User.username.ilike(pattern))
         )
     
     transactions = query.order_by(desc(Transaction.created_at)).paginate(
@@ -207,20 +252,42 @@ def security():
     """Security monitoring dashboard لوحة تحكم مراقبة الامان"""
     #الفلترة
     # Recent failed login attempts محاولات تسجيل الدخول الاخيرة الفاشله
-    failed_logins = LoginAttempt.query.filter_by(success=False).order_by(desc(LoginAttempt.attempted_at)).limit(50).all()
+    # Only the columns the template renders, returned as plain rows
+    failed_logins = db.session.execute(
+        select(
+            LoginAttempt.username,
+            LoginAttempt.ip_address,
+            LoginAttempt.user_agent,
+            LoginAttempt.attempted_at
+        ).where(LoginAttempt.success == False)
+        .order_by(desc(LoginAttempt.attempted_at))
+        .limit(50)
+    ).all()
     
     # Locked accounts حسابات مقفله
-    locked_accounts = User.query.filter(User.account_locked_until > datetime.utcnow()).all()
+    locked_accounts = db.session.execute(
+        select(
+            User.id,
+            User.username,
+            User.full_name,
+            User.email,
+            User.failed_login_attempts,
+            User.account_locked_until
+        ).where(User.account_locked_until > datetime.utcnow())
+    ).all()
     
     # Suspicious IP addresses (multiple failed attempts محاولات عديده لتسجيل الفاشل) عناوين مشبوهه 
-    suspicious_ips = db.session.query(
-        LoginAttempt.ip_address,
-        func.count(LoginAttempt.id).label('attempt_count')
-    ).filter(
-        LoginAttempt.success == False,
-        LoginAttempt.attempted_at >= datetime.utcnow() - timedelta(hours=24)
-    ).group_by(LoginAttempt.ip_address).having(
-        func.count(LoginAttempt.id) >= 5
+    # Aggregated server-side; covered by ix_login_attempts_ip_success_attempted
+    suspicious_ips = db.session.execute(
+        select(
+            LoginAttempt.ip_address,
+            func.count(LoginAttempt.id).label('attempt_count')
+        ).where(
+            LoginAttempt.success == False,
+            LoginAttempt.attempted_at >= datetime.utcnow() - timedelta(hours=24)
+        ).group_by(LoginAttempt.ip_address).having(
+            func.count(LoginAttempt.id) >= 5
+        )
     ).all()
     
     return render_template('admin/security.html',
@@ -235,28 +302,35 @@ def reports():
     """Generate system reports انشاء تقارير النظام"""
     # User registration trends (last 30 days) تسجيل المستخدم اخر 30 يوم
     thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    daily_registrations = db.session.query(
-        func.date(User.created_at).label('date'),
-        func.count(User.id).label('count')
-    ).filter(
-        User.created_at >= thirty_days_ago
-    ).group_by(func.date(User.created_at)).all()
+    # Core selects return plain rows; no ORM instances are built for the aggregates
+    daily_registrations = db.session.execute(
+        select(
+            func.date(User.created_at).label('date'),
+            func.count(User.id).label('count')
+        ).where(
+            User.created_at >= thirty_days_ago
+        ).group_by(func.date(User.created_at))
+    ).all()
     
     # Transaction volume trends اتجاهات حجم المعاملات
-    daily_transactions = db.session.query(
-        func.date(Transaction.created_at).label('date'),
-        func.count(Transaction.id).label('count'),
-        func.sum(Transaction.amount).label('total_amount')
-        #حجم المبالاغ الذي حدث عليها معاملات
-    ).filter(
-        Transaction.created_at >= thirty_days_ago
-    ).group_by(func.date(Transaction.created_at)).all()
+    daily_transactions = db.session.execute(
+        select(
+            func.date(Transaction.created_at).label('date'),
+            func.count(Transaction.id).label('count'),
+            func.sum(Transaction.amount).label('total_amount')
+            #حجم المبالاغ الذي حدث عليها معاملات
+        ).where(
+            Transaction.created_at >= thirty_days_ago
+        ).group_by(func.date(Transaction.created_at))
+    ).all()
     
     # Account type distribution
-    account_types = db.session.query(
-        Account.account_type,
-        func.count(Account.id).label('count')
-    ).group_by(Account.account_type).all()
+    account_types = db.session.execute(
+        select(
+            Account.account_type,
+            func.count(Account.id).label('count')
+        ).group_by(Account.account_type)
+    ).all()
     
     return render_template('admin/reports.html',
                          daily_registrations=daily_registrations,
@@ -268,21 +342,34 @@ def reports():
 @admin_required
 def system_logs():
     """View system logs عرض سجلات النظام"""
-    page = request.args.get('page', 1, type=int)
-    
-    # All login attempts with pagination كل محاولات تسجيل الدخول مع ترقيم الصفحات
-    login_attempts = LoginAttempt.query.order_by(desc(LoginAttempt.attempted_at)).paginate(
-        page=page, per_page=100, error_out=False
-    )
-    
-    return render_template('admin/system_logs.html', login_attempts=login_attempts)
+    before = request.args.get('before', type=int)
+    per_page = 100
+    
+    # Keyset pagination on the primary key avoids COUNT(*) over the whole log table
+    # ترقيم الصفحات بالمؤشر بدلا من عد كل السجلات
+    query = LoginAttempt.query
+    if before:
+        query = query.filter(LoginAttempt.id < before)
+    
+    login_attempts = query.order_by(desc(LoginAttempt.id)).limit(per_page + 1).all()
+    
+    # Fetch one extra row to know whether an older page exists
+    next_cursor = None
+    if len(login_attempts) > per_page:
+        login_attempts = login_attempts[:per_page]
+        next_cursor = login_attempts[-1].id
+    
+    return render_template('admin/system_logs.html',
+                         login_attempts=login_attempts,
+                         next_cursor=next_cursor,
+                         before=before)
 
 @admin_bp.route('/user/<int:user_id>/add_balance', methods=['POST'])
 @login_required
 @admin_required
 def add_balance(user_id):
     """Add balance to user account (Admin only المسؤول فقط يقدر يضيف) اضافة زلط الى حساب المستخدم"""
-    user = User.query.get_or_404(user_id)
+    user = _get_or_404(User, user_id)
     
     # Get form data
     amount_raw = (request.form.get('amount') or '').strip()
@@ -319,10 +406,12 @@ def add_balance(user_id):
                 account_type='checking',
                 balance=Decimal('0.00')
             )
-            db.session.add(account)
+            # Commit the account first so it has an id for the transaction record
+            account.insert_with_retry()
         
         # Update account balance تحديث رصيد الحساب
-        account.balance = (account.balance or Decimal('0.00')) + amount_dec
+        # Incremented in SQL, so no Python-side Decimal arithmetic on the stored balance
+        account.balance = func.coalesce(Account.balance, 0) + amount_dec
         
         # Create transaction record انشاء سجل المعامله 
         #deposit = ايداع
@@ -339,11 +428,12 @@ def add_balance(user_id):
         
         # Save changes
         db.session.commit()
+        invalidate_dashboard_stats()
         
         return jsonify({
             'success': True,
-            'message': f'تم إضافة ${float(amount_dec):.2f} بنجاح إلى حساب المستخدم {user.username}',
-            'new_balance': float(account.balance)
+            'message': f'تم إضافة ${amount_dec:.2f} بنجاح إلى حساب المستخدم {user.username}',
+            'new_balance': f'{account.balance:.2f}'
         })
         
     except Exception as e:
@@ -2,13 +2,18 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from flask_login import login_user, logout_user, login_required, current_user
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from models.user import User, LoginAttempt, db
+from sqlalchemy import exists
+from models.user import User, LoginAttempt, db, dialect_insert, password_hasher, LOCKOUT_THRESHOLD
 from utils.security import SecurityUtils
+from utils.attempt_sink import attempt_sink
 from datetime import datetime
 import re
 
 auth_bp = Blueprint('auth', __name__, url_prefix='/auth')
 
+_USERNAME_RE = re.compile(r'^[a-zA-Z0-9_]+$')
+_EMAIL_RE = re.compile(r'^[^@]+@[^@]+\.[^@]+$')
+
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
     """Secure login with rate limiting and account lockout"""
@@ -16,7 +21,7 @@ def login():
         return redirect(url_for('dashboard.index'))
     
     if request.method == 'POST':
-        username = SecurityUtils.sanitize_input(request.form.get('username', ''))
+        username = SecurityUtils.sanitize_plain(request.form.get('username', ''))
         password = request.form.get('password', '')
         
         # Input validation
@@ -28,23 +33,22 @@ def login():
         client_ip = SecurityUtils.get_client_ip()
         user_agent = request.headers.get('User-Agent', '')
         
-        # Check for user
-        user = User.query.filter_by(username=username).first()
-        
-        # Log login attempt
-        login_attempt = LoginAttempt(
-            ip_address=client_ip,
-            username=username,
-            success=False,
-            user_agent=user_agent
-        )
+        # Check for user (cached; the row is loaded only when it must change)
+        auth_record = User.get_auth_record(username)
         
-        if user and user.is_active:
+        if auth_record and auth_record['is_active']:
             # Check if account is locked
+            locked_until = auth_record['account_locked_until']
+            if locked_until and datetime.utcnow() < locked_until:
+                flash('الحساب مقفل مؤقتاً. يرجى المحاولة لاحقاً', 'error')
+                attempt_sink.put(client_ip, username, user_agent)
+                return render_template('auth/login.html')
+            
+            # The cache can predate a lock committed by another worker: the live row decides
+            user = db.session.get(User, auth_record['id'])
             if user.is_account_locked():
                 flash('الحساب مقفل مؤقتاً. يرجى المحاولة لاحقاً', 'error')
-                db.session.add(login_attempt)
-                db.session.commit()
+                attempt_sink.put(client_ip, username, user_agent)
                 return render_template('auth/login.html')
             
             # Verify password
@@ -52,12 +56,22 @@ def login():
                 # Successful login
                 user.unlock_account()
                 user.update_last_login()
-                login_attempt.success = True
                 
+                # Successful logins are rare and security-relevant: log synchronously
+                login_attempt = LoginAttempt(
+                    ip_address=client_ip,
+                    username=username,
+                    success=True,
+                    user_agent=user_agent
+                )
                 db.session.add(login_attempt)
                 db.session.commit()
+                user.clear_auth_state()  # Only after the commit, so no stale row is re-cached
                 
                 login_user(user, remember=False)
+                # Claims read by the user loader and the rate limiter admin exemption
+                session['role'] = user.role
+                session['is_active'] = user.is_active
                 flash('تم تسجيل الدخول بنجاح', 'success')
                 
                 # Redirect to next page or dashboard
@@ -66,15 +80,18 @@ def login():
                     return redirect(next_page)
                 return redirect(url_for('dashboard.index'))
             else:
-                # Failed login
-                user.lock_account()
+                # Failed login: counted in Redis, the row is written only to lock it
+                failed_attempts = User.record_failed_login(username)
+                if failed_attempts >= LOCKOUT_THRESHOLD:
+                    user.lock_account(failed_attempts)
+                    db.session.commit()
+                    user.clear_auth_state()  # The lock period starts a fresh count
                 flash('اسم المستخدم أو كلمة المرور غير صحيحة', 'error')
         else:
             flash('اسم المستخدم أو كلمة المرور غير صحيحة', 'error')
         
-        # Log failed attempt
-        db.session.add(login_attempt)
-        db.session.commit()
+        # Log failed attempt (batched off the request thread)
+        attempt_sink.put(client_ip, username, user_agent)
     
     # CSRF token is provided by Flask-WTF via csrf_token() in templates
     return render_template('auth/login.html')
@@ -87,10 +104,10 @@ def register():
     
     if request.method == 'POST':
         # Get and sanitize form data
-        username = SecurityUtils.sanitize_input(request.form.get('username', ''))
-        email = SecurityUtils.sanitize_input(request.form.get('email', ''))
-        full_name = SecurityUtils.sanitize_input(request.form.get('full_name', ''))
-        phone = SecurityUtils.sanitize_input(request.form.get('phone', ''))
+        username = SecurityUtils.sanitize_plain(request.form.get('username', ''))
+        email = SecurityUtils.sanitize_plain(request.form.get('email', ''))
+        full_name = SecurityUtils.sanitize_plain(request.form.get('full_name', ''))
+        phone = SecurityUtils.sanitize_plain(request.form.get('phone', ''))
         password = request.form.get('password', '')
         confirm_password = request.form.get('confirm_password', '')
         # CSRF is validated by Flask-WTF CSRFProtect
@@ -101,10 +118,10 @@ def register():
         if not username or len(username) < 3:
             errors.append('اسم المستخدم يجب أن يكون 3 أحرف على الأقل')
         
-        if not re.match(r'^[a-zA-Z0-9_]+$', username):
+        if not _USERNAME_RE.match(username):
             errors.append('اسم المستخدم يجب أن يحتوي على أحرف وأرقام فقط')
         
-        if not email or not re.match(r'^[^@]+@[^@]+\.[^@]+$', email):
+        if not email or not _EMAIL_RE.match(email):
             errors.append('البريد الإلكتروني غير صحيح')
         
         if not full_name or len(full_name) < 2:
@@ -118,37 +135,41 @@ def register():
         if not is_strong:
             errors.append(password_msg)
         
-        # Check for existing users
-        if User.query.filter_by(username=username).first():
-            errors.append('اسم المستخدم موجود بالفعل')
-        
-        if User.query.filter_by(email=email).first():
-            errors.append('البريد الإلكتروني موجود بالفعل')
-        
         if errors:
             for error in errors:
                 flash(error, 'error')
             return render_template('auth/register.html')
         
         # Create new user
+        # One atomic INSERT; the unique indexes on username/email decide duplicates
         try:
-            user = User(
-                username=username,
-                email=email,
-                full_name=full_name,
-                phone=phone
-            )
-            user.set_password(password)
-            
-            db.session.add(user)
+            user_id = db.session.execute(
+                dialect_insert(User).values(
+                    username=username,
+                    email=email,
+                    full_name=full_name,
+                    phone=phone,
+                    password_hash=password_hasher.hash(password)
+                ).on_conflict_do_nothing().returning(User.id)
+            ).scalar()
             db.session.commit()
-            
-            flash('تم إنشاء الحساب بنجاح. يمكنك تسجيل الدخول الآن', 'success')
-            return redirect(url_for('auth.login'))
-            
         except Exception as e:
             db.session.rollback()
             flash('حدث خطأ أثناء إنشاء الحساب', 'error')
+            return render_template('auth/register.html')
+        
+        if user_id is None:
+            # Conflict: find out which field is taken (only on this rare path)
+            if db.session.query(exists().where(User.username == username)).scalar():
+                flash('اسم المستخدم موجود بالفعل', 'error')
+            if db.session.query(exists().where(User.email == email)).scalar():
+                flash('البريد الإلكتروني موجود بالفعل', 'error')
+            return render_template('auth/register.html')
+        
+        User.invalidate_auth_cache_for(username)  # Drop a cached "unknown username" entry
+        
+        flash('تم إنشاء الحساب بنجاح. يمكنك تسجيل الدخول الآن', 'success')
+        return redirect(url_for('auth.login'))
     
     # CSRF token is provided by Flask-WTF via csrf_token() in templates
     return render_template('auth/register.html')
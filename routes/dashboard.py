@@ -1,33 +1,96 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify, make_response, current_app, abort
 from flask_login import login_required, current_user
 from models.user import User, Account, Transaction, db
+from sqlalchemy import func, select, update, case, or_, and_, exists, union_all, desc, tuple_
+from sqlalchemy.orm import aliased
 from utils.security import SecurityUtils
+from utils.stats import invalidate_dashboard_stats
 from decimal import Decimal
 from datetime import datetime
+import hashlib
+import time
 import re
 
 dashboard_bp = Blueprint('dashboard', __name__, url_prefix='/dashboard')
 
+def _dashboard_etag(accounts, last_transaction_id):
+    """Fingerprint everything the dashboard page renders"""
+    # Rotate before the embedded CSRF token can expire in a cached copy
+    csrf_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT')
+    csrf_epoch = int(time.time()) // (csrf_limit // 2) if csrf_limit else 0
+    state = (
+        current_user.id, current_user.full_name, current_user.last_login,
+        request.remote_addr, session.get('csrf_token'), csrf_epoch,
+        last_transaction_id, [tuple(account) for account in accounts]
+    )
+    return hashlib.blake2b(repr(state).encode(), digest_size=8).hexdigest()
+
+def _select_transactions():
+    """Transaction columns the history pages render, with both account numbers joined in"""
+    from_account = aliased(Account)
+    to_account = aliased(Account)
+    return select(
+        Transaction.id,
+        Transaction.transaction_type,
+        Transaction.amount,
+        Transaction.description,
+        Transaction.from_account_id,
+        Transaction.to_account_id,
+        Transaction.created_at,
+        Transaction.ip_address,
+        from_account.account_number.label('from_account_number'),
+        to_account.account_number.label('to_account_number')
+    ).outerjoin(from_account, Transaction.from_account_id == from_account.id)\
+     .outerjoin(to_account, Transaction.to_account_id == to_account.id)
+
 @dashboard_bp.route('/')
 @login_required
 def index():
     """Main dashboard page"""
-    # Get user's accounts
-    accounts = Account.query.filter_by(user_id=current_user.id, is_active=True).all()
+    user_id = current_user.id
+    
+    # Get user's accounts (only the columns the page renders)
+    accounts = db.session.execute(
+        select(
+            Account.id,
+            Account.account_number,
+            Account.account_type,
+            Account.balance,
+            Account.created_at
+        ).where(Account.user_id == user_id, Account.is_active == True)
+    ).all()
     
-    # Get recent transactions المعاملات الحديثة
-    recent_transactions = Transaction.query.filter_by(user_id=current_user.id)\
-                                         .order_by(Transaction.created_at.desc())\
-                                         .limit(10).all()
+    # Unchanged since the browser's copy: skip the remaining queries and rendering
+    last_transaction_id = db.session.execute(
+        select(func.max(Transaction.id)).where(Transaction.user_id == user_id)
+    ).scalar()
+    etag = _dashboard_etag(accounts, last_transaction_id)
+    if request.if_none_match.contains(etag) and not session.get('_flashes'):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
     
-    # Calculate total balance
-    total_balance = sum(account.balance for account in accounts)
+    # Count recent transactions المعاملات الحديثة (the page only shows how many, up to 10)
+    recent_transaction_count = db.session.execute(
+        select(func.count()).select_from(
+            select(Transaction.id).where(Transaction.user_id == user_id).limit(10).subquery()
+        )
+    ).scalar()
+    
+    # Calculate total balance in the database
+    total_balance = db.session.execute(
+        select(func.coalesce(func.sum(Account.balance), 0))
+        .where(Account.user_id == user_id, Account.is_active == True)
+    ).scalar()
     
     # CSRF token is provided in templates via csrf_token()
-    return render_template('dashboard/index.html', 
-                         accounts=accounts,
-                         recent_transactions=recent_transactions,
-                         total_balance=total_balance)
+    response = make_response(render_template('dashboard/index.html', 
+                                             accounts=accounts,
+                                             recent_transaction_count=recent_transaction_count,
+                                             total_balance=total_balance))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'  # Always revalidate
+    return response
 
 @dashboard_bp.route('/create_account', methods=['POST'])
 @login_required
@@ -35,7 +98,7 @@ def create_account():
     """Create new bank account انشاء حساب جاري او توفير"""
     # CSRF is validated by Flask-WTF CSRFProtect
     
-    account_type = SecurityUtils.sanitize_input(request.form.get('account_type', ''))
+    account_type = SecurityUtils.sanitize_plain(request.form.get('account_type', ''))
     
     # Validate account type
     if account_type not in ['checking', 'savings']:
@@ -43,11 +106,11 @@ def create_account():
         return redirect(url_for('dashboard.index'))
     
     # Check if user already has this type of account التحقق من انه لا يوجد حسابين من نفس النوع  توفير توفير
-    existing_account = Account.query.filter_by(
-        user_id=current_user.id, 
-        account_type=account_type,
-        is_active=True
-    ).first()
+    existing_account = db.session.query(exists().where(
+        Account.user_id == current_user.id,
+        Account.account_type == account_type,
+        Account.is_active == True
+    )).scalar()
     
     if existing_account:
         flash('لديك حساب من هذا النوع بالفعل', 'error')
@@ -61,8 +124,8 @@ def create_account():
             balance=Decimal('0.00')
         )
         
-        db.session.add(account)
-        db.session.commit()
+        account.insert_with_retry()
+        invalidate_dashboard_stats()
         
         flash(f'تم إنشاء حساب {account_type} بنجاح', 'success')
         
@@ -77,10 +140,10 @@ def create_account():
 def transfer():
     """Money transfer between accounts التحويلات بين الحسابات"""
     if request.method == 'POST':
-        from_account_id = request.form.get('from_account_id')
-        to_account_number = SecurityUtils.sanitize_input(request.form.get('to_account_number', ''))
-        amount_str = SecurityUtils.sanitize_input(request.form.get('amount', ''))
-        description = SecurityUtils.sanitize_input(request.form.get('description', ''))
+        from_account_id = request.form.get('from_account_id', type=int)
+        to_account_number = SecurityUtils.sanitize_plain(request.form.get('to_account_number', ''))
+        amount_str = SecurityUtils.sanitize_plain(request.form.get('amount', ''))
+        description = SecurityUtils.sanitize_plain(request.form.get('description', ''))
         # CSRF is validated by Flask-WTF CSRFProtect
         
         # Input validation
@@ -103,17 +166,20 @@ def transfer():
         try:
             amount = Decimal(amount_str)
             
-            # Get accounts
-            from_account = Account.query.filter_by(
-                id=from_account_id, 
-                user_id=current_user.id,
-                is_active=True
-            ).first()
+            # Get and lock both accounts in one query for the rest of the transaction
+            # Rows are locked in id order, so opposite transfers (A->B, B->A) cannot deadlock
+            accounts = db.session.execute(
+                select(Account).where(
+                    or_(
+                        and_(Account.id == from_account_id, Account.user_id == current_user.id),
+                        Account.account_number == to_account_number
+                    ),
+                    Account.is_active == True
+                ).order_by(Account.id).with_for_update()
+            ).scalars().all()
             
-            to_account = Account.query.filter_by(
-                account_number=to_account_number,
-                is_active=True
-            ).first()
+            from_account = next((a for a in accounts if a.id == from_account_id and a.user_id == current_user.id), None)
+            to_account = next((a for a in accounts if a.account_number == to_account_number), None)
             
             if not from_account:
                 flash('الحساب المرسل غير موجود', 'error')
@@ -133,8 +199,25 @@ def transfer():
                 return redirect(url_for('dashboard.transfer'))
             
             # Perform transfer اجراء التحويل
-            from_account.balance -= amount
-            to_account.balance += amount
+            # Both balances change in one UPDATE; the balance guard makes it safe
+            # even on databases that ignore FOR UPDATE
+            result = db.session.execute(
+                update(Account).where(
+                    or_(
+                        Account.id == to_account.id,
+                        and_(Account.id == from_account.id, Account.balance >= amount)
+                    )
+                ).values(
+                    balance=case(
+                        (Account.id == from_account.id, Account.balance - amount),
+                        else_=Account.balance + amount
+                    )
+                ).execution_options(synchronize_session=False)
+            )
+            if result.rowcount != 2:
+                db.session.rollback()
+                flash('الرصيد غير كافي', 'error')
+                return redirect(url_for('dashboard.transfer'))
             
             # Create transaction record انشاء سجل المعامله
             transaction = Transaction(
@@ -169,30 +252,68 @@ def transfer():
 @login_required
 def transactions():
     """View transaction history سجل المعاملات"""
-    page = request.args.get('page', 1, type=int)
+    before = request.args.get('before', type=datetime.fromisoformat)
+    before_id = request.args.get('before_id', type=int)
     per_page = 20
     
-    transactions = Transaction.query.filter_by(user_id=current_user.id)\
-                                  .order_by(Transaction.created_at.desc())\
-                                  .paginate(page=page, per_page=per_page, error_out=False)
+    # Keyset pagination on (created_at, id): each page is one index range scan, no COUNT(*)
+    # ترقيم الصفحات بالمؤشر بدلا من الإزاحة
+    query = _select_transactions().where(Transaction.user_id == current_user.id)
+    if before and before_id:
+        query = query.where(tuple_(Transaction.created_at, Transaction.id) < (before, before_id))
+    
+    transactions = db.session.execute(
+        query.order_by(Transaction.created_at.desc(), Transaction.id.desc()).limit(per_page + 1)
+    ).all()
     
-    return render_template('dashboard/transactions.html', transactions=transactions)
+    # Fetch one extra row to know whether an older page exists
+    next_cursor = None
+    if len(transactions) > per_page:
+        transactions = transactions[:per_page]
+        last = transactions[-1]
+        next_cursor = {'before': last.created_at.isoformat(), 'before_id': last.id}
+    
+    return render_template('dashboard/transactions.html',
+                         transactions=transactions,
+                         next_cursor=next_cursor,
+                         before=before)
 
 @dashboard_bp.route('/account/<int:account_id>')
 @login_required
 def account_details(account_id):
     """View specific account details"""
-    account = Account.query.filter_by(
-        id=account_id, 
-        user_id=current_user.id,
-        is_active=True
-    ).first_or_404()
+    account = db.session.execute(
+        select(
+            Account.id,
+            Account.account_number,
+            Account.account_type,
+            Account.balance,
+            Account.created_at,
+            Account.is_active
+        ).where(
+            Account.id == account_id,
+            Account.user_id == current_user.id,
+            Account.is_active == True
+        )
+    ).first()
+    if account is None:
+        abort(404)
     
     # Get account transactions
-    transactions = Transaction.query.filter(
-        (Transaction.from_account_id == account_id) | 
-        (Transaction.to_account_id == account_id)
-    ).order_by(Transaction.created_at.desc()).limit(50).all()
+    # UNION ALL of two index range scans (ix_tx_from / ix_tx_to) instead of an OR filter
+    sent = select(Transaction.id, Transaction.created_at)\
+        .where(Transaction.from_account_id == account_id)\
+        .order_by(Transaction.created_at.desc()).limit(50).subquery()
+    received = select(Transaction.id, Transaction.created_at)\
+        .where(Transaction.to_account_id == account_id)\
+        .order_by(Transaction.created_at.desc()).limit(50).subquery()
+    latest = union_all(select(sent), select(received))\
+        .order_by(desc('created_at')).limit(50).subquery()
+    transactions = db.session.execute(
+        _select_transactions()
+        .join(latest, Transaction.id == latest.c.id)
+        .order_by(Transaction.created_at.desc())
+    ).all()
     
     from datetime import datetime, timedelta
     
@@ -0,0 +1,113 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from sqlalchemy import insert
+from models.user import db, LoginAttempt
+
+logger = logging.getLogger(__name__)
+
+class AttemptSink:
+    """Buffer failed login attempts and insert them in batches from a background thread"""
+    
+    def __init__(self, app=None, batch_size=500, flush_interval=1.0, max_retries=5):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = queue.Queue()
+        self._failed = deque()  # (rows, attempts) batches waiting to be written again
+        self._lock = threading.Lock()
+        self._pid = None
+        self._atexit_registered = False
+        if app:
+            self.init_app(app)
+    
+    def init_app(self, app):
+        """Bind the sink to the Flask app whose database receives the rows"""
+        self.app = app
+        if not self._atexit_registered:
+            atexit.register(self.flush)
+            self._atexit_registered = True
+    
+    def put(self, ip_address, username, user_agent, success=False):
+        """Queue one attempt; no database work happens on the request thread"""
+        self._ensure_worker()
+        self._queue.put({
+            'ip_address': ip_address,
+            'username': username,
+            'success': success,
+            'user_agent': user_agent,
+            'attempted_at': datetime.utcnow()
+        })
+    
+    def flush(self):
+        """Write everything queued so far, retrying failed batches up to max_retries"""
+        rows = self._drain()
+        while rows:
+            self._write(rows)
+            rows = self._drain()
+        while self._failed:
+            time.sleep(self.flush_interval)
+            self._retry_failed()
+    
+    def _ensure_worker(self):
+        # Start lazily and once per process, so forked gunicorn workers get their own thread
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name='login-attempt-sink', daemon=True).start()
+                self._pid = os.getpid()
+    
+    def _drain(self, first=None):
+        rows = [first] if first else []
+        while len(rows) < self.batch_size:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+    
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                first = None
+            if first is not None:
+                self._write(self._drain(first))
+            self._retry_failed()
+    
+    def _retry_failed(self):
+        # Only the batches present now; a batch failing again goes to the back for the next round
+        for _ in range(len(self._failed)):
+            try:
+                rows, attempts = self._failed.popleft()
+            except IndexError:
+                break
+            self._write(rows, attempts)
+    
+    def _write(self, rows, attempts=0):
+        with self.app.app_context():
+            try:
+                db.session.execute(insert(LoginAttempt), rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # Transient errors (e.g. SQLite "database is locked") must not lose audit rows
+                if attempts < self.max_retries:
+                    logger.warning('Failed to write %d login attempts, retry %d of %d',
+                                   len(rows), attempts + 1, self.max_retries, exc_info=True)
+                    self._failed.append((rows, attempts + 1))
+                else:
+                    logger.exception('Dropping %d login attempts after %d retries',
+                                     len(rows), self.max_retries)
+            finally:
+                db.session.remove()
+
+attempt_sink = AttemptSink()
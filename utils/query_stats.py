@@ -0,0 +1,29 @@
+import logging
+from collections import Counter
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS, NO_CACHE_KEY
+
+logger = logging.getLogger(__name__)
+
+# Process-wide counters of compiled-statement cache outcomes
+cache_stats = Counter()
+
+def _record_cache_stats(conn, cursor, statement, parameters, context, executemany):
+    """Count compiled cache hits/misses and warn about statements that cannot be cached"""
+    # DDL and raw driver SQL (e.g. inspection PRAGMAs) never go through the compiled cache
+    if context is None or context.isddl or context.compiled is None:
+        return
+    outcome = context.cache_hit
+    if outcome is CACHE_HIT:
+        cache_stats['hit'] += 1
+    elif outcome is CACHE_MISS:
+        cache_stats['miss'] += 1
+    elif outcome is NO_CACHE_KEY:
+        cache_stats['uncacheable'] += 1
+        logger.warning('Statement has no cache key and is recompiled every time: %s', statement)
+
+def init_query_cache_stats():
+    """Register the compile cache listener once for all engines (development only)"""
+    if not event.contains(Engine, 'after_cursor_execute', _record_cache_stats):
+        event.listen(Engine, 'after_cursor_execute', _record_cache_stats)
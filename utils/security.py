@@ -1,14 +1,39 @@
 import os
-import secrets
 import hashlib
+import string
+import time
 from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, hmac, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import base64
+from decimal import Decimal
 import bleach
 import re
-from flask import request, session
-from functools import wraps
+from flask import request
+from functools import wraps, lru_cache
+
+# Control characters and angle brackets: nothing a plain-text field needs
+_CTRL_RE = re.compile(r'[\x00-\x1f\x7f<>]')
+_ACCOUNT_NUMBER_RE = re.compile(r'^\d{10}$')
+_AMOUNT_RE = re.compile(r'^\d{1,7}(\.\d{1,2})?\Z')
+_MAX_AMOUNT = Decimal('1000000')  # Max 1M per transaction
+_PW_UPPER = frozenset(string.ascii_uppercase)
+_PW_LOWER = frozenset(string.ascii_lowercase)
+_PW_SYMBOLS = frozenset('!@#$%^&*')
+
+@lru_cache(maxsize=8)
+def _derive_fernet_key(password, salt=b'stable_salt_for_demo'):
+    """Derive a Fernet key once per (password, salt); PBKDF2 at 100k iterations is costly"""
+    # In production, use random salt per encryption
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        iterations=100000,
+    )
+    return base64.urlsafe_b64encode(kdf.derive(password))
 
 class SecurityUtils:
     def __init__(self, app=None):
@@ -22,19 +47,15 @@ class SecurityUtils:
         self.app = app
         encryption_key = app.config.get('ENCRYPTION_KEY', 'default-key')
         self._cipher_suite = self._get_cipher_suite(encryption_key)
+        
+        # Fernet subkeys (signing || encryption) split once for the batch helpers
+        raw_key = base64.urlsafe_b64decode(_derive_fernet_key(encryption_key.encode()))
+        self._signing_key = raw_key[:16]
+        self._encryption_key = raw_key[16:]
     
     def _get_cipher_suite(self, password):
         """Generate cipher suite from password"""
-        password = password.encode()
-        salt = b'stable_salt_for_demo'  # In production, use random salt per encryption
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
-        )
-        key = base64.urlsafe_b64encode(kdf.derive(password))
-        return Fernet(key)
+        return Fernet(_derive_fernet_key(password.encode()))
     
     def encrypt_sensitive_data(self, data):
         """Encrypt sensitive data like account numbers"""
@@ -51,12 +72,64 @@ class SecurityUtils:
         except:
             return None
     
+    def encrypt_many(self, data_list):
+        """Encrypt several values with one key setup; tokens are Fernet-compatible"""
+        values = [str(data).encode() if data else None for data in data_list]
+        # One urandom call for all IVs, one HMAC key schedule copied per item
+        ivs = os.urandom(16 * len(values))
+        timestamp = int(time.time()).to_bytes(8, 'big')
+        hmac_base = hmac.HMAC(self._signing_key, hashes.SHA256())
+        
+        tokens = []
+        for i, (data, value) in enumerate(zip(data_list, values)):
+            if value is None:
+                tokens.append(data)
+                continue
+            iv = ivs[16 * i:16 * (i + 1)]
+            padder = padding.PKCS7(algorithms.AES.block_size).padder()
+            padded = padder.update(value) + padder.finalize()
+            encryptor = Cipher(algorithms.AES(self._encryption_key), modes.CBC(iv)).encryptor()
+            basic_parts = b'\x80' + timestamp + iv + encryptor.update(padded) + encryptor.finalize()
+            h = hmac_base.copy()
+            h.update(basic_parts)
+            tokens.append(base64.urlsafe_b64encode(basic_parts + h.finalize()).decode())
+        return tokens
+    
+    def decrypt_many(self, encrypted_list):
+        """Decrypt several Fernet tokens; invalid tokens decrypt to None"""
+        hmac_base = hmac.HMAC(self._signing_key, hashes.SHA256())
+        
+        results = []
+        for encrypted_data in encrypted_list:
+            if not encrypted_data:
+                results.append(encrypted_data)
+                continue
+            try:
+                token = base64.urlsafe_b64decode(encrypted_data.encode())
+                if len(token) < 57 or token[0] != 0x80:
+                    raise ValueError('Malformed token')
+                h = hmac_base.copy()
+                h.update(token[:-32])
+                h.verify(token[-32:])
+                iv = token[9:25]
+                decryptor = Cipher(algorithms.AES(self._encryption_key), modes.CBC(iv)).decryptor()
+                padded = decryptor.update(token[25:-32]) + decryptor.finalize()
+                unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+                results.append((unpadder.update(padded) + unpadder.finalize()).decode())
+            except (ValueError, InvalidSignature, UnicodeDecodeError):
+                results.append(None)
+        return results
+    
     @staticmethod
     def sanitize_input(input_data, allowed_tags=None):
         """Sanitize user input to prevent XSS"""
         if not input_data:
             return input_data
         
+        # Plain ASCII letters/digits cannot carry markup; skip the HTML tokenizer
+        if input_data.isascii() and input_data.isalnum():
+            return input_data
+        
         if allowed_tags is None:
             allowed_tags = []
         
@@ -64,23 +137,29 @@ class SecurityUtils:
         cleaned = bleach.clean(input_data, tags=allowed_tags, strip=True)
         return cleaned.strip()
     
+    @staticmethod
+    def sanitize_plain(input_data):
+        """Sanitize plain-text input (no HTML allowed) without running an HTML parser"""
+        if not input_data:
+            return input_data
+        return _CTRL_RE.sub('', input_data).strip()
+    
     @staticmethod
     def validate_account_number(account_number):
         """Validate account number format"""
         if not account_number:
             return False
         # Only allow digits, length 10
-        pattern = r'^\d{10}$'
-        return bool(re.match(pattern, account_number))
+        return bool(_ACCOUNT_NUMBER_RE.match(account_number))
     
     @staticmethod
     def validate_amount(amount_str):
         """Validate monetary amount"""
-        try:
-            amount = float(amount_str)
-            return amount > 0 and amount <= 1000000  # Max 1M per transaction
-        except (ValueError, TypeError):
+        # Up to 7 integer digits and 2 decimals; rejects exponents, signs and NaN up front
+        if not amount_str or not _AMOUNT_RE.match(amount_str):
             return False
+        amount = Decimal(amount_str)
+        return amount > 0 and amount <= _MAX_AMOUNT
     
     @staticmethod
     def validate_password_strength(password):
@@ -88,45 +167,36 @@ class SecurityUtils:
         if len(password) < 8:
             return False, "كلمة المرور يجب أن تكون 8 أحرف على الأقل"
         
-        if not re.search(r'[A-Z]', password):
+        # One pass to build the character set, then cheap set checks per rule
+        chars = set(password)
+        
+        if chars.isdisjoint(_PW_UPPER):
             return False, "كلمة المرور يجب أن تحتوي على حرف كبير"
         
-        if not re.search(r'[a-z]', password):
+        if chars.isdisjoint(_PW_LOWER):
             return False, "كلمة المرور يجب أن تحتوي على حرف صغير"
         
-        if not re.search(r'\d', password):
+        if not any(ch.isdecimal() for ch in chars):  # Same digits as regex \d
             return False, "كلمة المرور يجب أن تحتوي على رقم"
         
-        if not re.search(r'[!@#$%^&*]', password):
+        if chars.isdisjoint(_PW_SYMBOLS):
             return False, "كلمة المرور يجب أن تحتوي على رمز خاص (!@#$%^&*)"
         
         return True, "كلمة مرور قوية"
     
-    @staticmethod
-    def generate_csrf_token():
-        """Generate CSRF token"""
-        return secrets.token_hex(32)
-    
-    @staticmethod
-    def validate_csrf_token(token):
-        """Validate CSRF token"""
-        if not token:
-            return False
-        stored_token = session.get('csrf_token')
-        if not stored_token:
-            return False
-        return token == stored_token
-    
     @staticmethod
     def get_client_ip():
-        """Get client IP address safely"""
-        if request.environ.get('HTTP_X_FORWARDED_FOR'):
-            return request.environ['HTTP_X_FORWARDED_FOR'].split(',')[0].strip()
-        return request.environ.get('REMOTE_ADDR', 'unknown')
+        """Get client IP address safely (X-Forwarded-For is resolved by ProxyFix)"""
+        return request.remote_addr or 'unknown'
     
     @staticmethod
     def hash_sensitive_data(data):
-        """Hash sensitive data for logging/auditing"""
+        """Hash sensitive data for logging/auditing (64-bit BLAKE2b, 16 hex chars)"""
+        return hashlib.blake2b(str(data).encode(), digest_size=8).hexdigest()
+    
+    @staticmethod
+    def hash_sensitive_data_sha256(data):
+        """Previous SHA-256 based audit hash, for comparing against existing records"""
         return hashlib.sha256(str(data).encode()).hexdigest()[:16]
 
 def require_auth(f):
@@ -139,14 +209,3 @@ def require_auth(f):
             return redirect(url_for('auth.login'))
         return f(*args, **kwargs)
     return decorated_function
-
-def require_csrf(f):
-    """Decorator to require CSRF token"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if request.method == 'POST':
-            token = request.form.get('csrf_token')
-            if not SecurityUtils.validate_csrf_token(token):
-                return "CSRF token validation failed", 403
-        return f(*args, **kwargs)
-    return decorated_function
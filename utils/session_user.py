@@ -0,0 +1,31 @@
+from functools import cached_property
+from flask_login import UserMixin
+from models.user import db, User
+
+class SessionUser(UserMixin):
+    """Logged-in user built from session claims; the database row is loaded on first use"""
+    
+    def __init__(self, user_id, role, is_active=True):
+        self.id = user_id
+        self.role = role
+        self._is_active = is_active
+    
+    @property
+    def is_active(self):
+        return self._is_active
+    
+    def is_admin(self):
+        """Check if user is admin (from the session claim, no query)"""
+        return self.role == 'admin'
+    
+    @cached_property
+    def user(self):
+        """Full User row, fetched only when a route or template needs it"""
+        return db.session.get(User, self.id)
+    
+    def __getattr__(self, name):
+        # Any attribute not carried by the session falls through to the User row
+        return getattr(self.user, name)
+    
+    def __repr__(self):
+        return f'<SessionUser {self.id}>'
@@ -0,0 +1,52 @@
+from datetime import datetime
+from sqlalchemy import func, case, true
+from models.user import db, User, Account, Transaction, LoginAttempt
+from utils.cache import cache
+
+@cache.memoize(timeout=30)
+def dashboard_stats():
+    """System, security and financial statistics in a single round-trip
+    الاحصاءات العامة والامنية والمالية في استعلام واحد"""
+    now = datetime.utcnow()
+    
+    user_stats = db.session.query(
+        func.count(User.id).label('total'),
+        func.coalesce(func.sum(case((User.is_active == True, 1), else_=0)), 0).label('active'),
+        func.coalesce(func.sum(case((User.account_locked_until > now, 1), else_=0)), 0).label('locked')
+    ).subquery()
+    
+    account_stats = db.session.query(
+        func.count(Account.id).label('total'),
+        func.coalesce(func.sum(Account.balance), 0).label('balance')
+    ).subquery()
+    
+    transaction_count = db.session.query(func.count(Transaction.id)).scalar_subquery()
+    
+    failed_logins_count = db.session.query(func.count(LoginAttempt.id)).filter(
+        LoginAttempt.success == False,
+        LoginAttempt.attempted_at >= now.date()
+    ).scalar_subquery()
+    
+    row = db.session.query(
+        user_stats.c.total,
+        user_stats.c.active,
+        user_stats.c.locked,
+        account_stats.c.total,
+        account_stats.c.balance,
+        transaction_count,
+        failed_logins_count
+    ).select_from(user_stats).join(account_stats, true()).one()  # both sides are single rows
+    
+    return {
+        'total_users': row[0],
+        'active_users': row[1],
+        'locked_accounts': row[2],
+        'total_accounts': row[3],
+        'total_balance': row[4],
+        'total_transactions': row[5],
+        'failed_logins_today': row[6]
+    }
+
+def invalidate_dashboard_stats():
+    """Drop cached dashboard statistics after a write that changes them"""
+    cache.delete_memoized(dashboard_stats)
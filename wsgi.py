@@ -0,0 +1,16 @@
+# Production entry point: gunicorn -k gevent -w $(nproc) --worker-connections 1000 'wsgi:app'
+# gevent must patch the standard library before anything else is imported
+from gevent import monkey
+monkey.patch_all()
+
+import os
+
+# Let psycopg2 yield to other greenlets while waiting on PostgreSQL
+# (requires psycopg2 and psycogreen when DATABASE_URL points at PostgreSQL)
+if (os.environ.get('DATABASE_URL') or '').startswith('postgres'):
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+from app import create_app
+
+app = create_app(os.environ.get('FLASK_CONFIG', 'production'))